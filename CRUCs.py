@@ -22,10 +22,14 @@
 import shutil
 import getpass
 import sqlite3
+import contextlib
+import datetime
+import shelve
 import argparse
 import sys
 import os
-import pdb
+import pathlib
+import numpy as np
 import pandas as pd
 
 # Try to import CarbonMeter
@@ -35,6 +39,24 @@ except ImportError:
     print("CarbonMeter is not installed. Please install it to compute carbon load.")
 
 
+# Cache of earlier query results (safe to delete at any time)
+QUERY_CACHE = os.path.join(os.path.expanduser("~"), ".cache", "CRUCs", "queries")
+
+# ANSI color codes used for the terminal output
+COLORS = {
+    'red': '\033[31m',
+    'green': '\033[32m',
+    'yellow': '\033[33m',
+    'blue': '\033[34m',
+    'magenta': '\033[35m',
+    'cyan': '\033[36m',
+    'white': '\033[37m',
+    'purple': '\033[94m',
+    'magenta': '\033[95m',
+}
+RESET_COLOR = '\033[0m'
+
+
 ## ------------------- Functions ------------------- ##
 
 def format_numeric_result(number):
@@ -55,20 +77,7 @@ def format_numeric_result(number):
 
 def color_text(text, color):
 
-    colors = {
-        'red': '\033[31m',
-        'green': '\033[32m',
-        'yellow': '\033[33m',
-        'blue': '\033[34m',
-        'magenta': '\033[35m',
-        'cyan': '\033[36m',
-        'white': '\033[37m',
-        'purple': '\033[94m',
-        'magenta': '\033[95m',
-    }
-
-    reset_color = '\033[0m'
-    return f"{colors[color]}{text}{reset_color}"
+    return f"{COLORS[color]}{text}{RESET_COLOR}"
 
 
 
@@ -103,7 +112,7 @@ class CRUCs(object):
         #data = pd.read_csv(input_file, sep = ',', index_col=False)
 
         # Check if user exists
-        if self.query_user not in self.query_data.user.values and self.query_user is not None:
+        if self.query_user not in self.query_data.index and self.query_user is not None:
             print(f"ERROR: The user {color_text(self.query_user, 'blue')} does not exist in the log file.")
             sys.exit()
 
@@ -118,24 +127,59 @@ class CRUCs(object):
     def query_torque_database(self):
         """
         Extract the requested data from the torque_log database.
+        The result is cached, so the database is only queried again once it
+        has changed (or on a new day, as the period is counted from today).
         """
 
-        # Open connection to database
-        conn = sqlite3.connect(self.db_path,
-                            detect_types=sqlite3.PARSE_DECLTYPES |
-                            sqlite3.PARSE_COLNAMES)
+        # Return the result of an identical earlier query. The pandas version is part
+        # of the key, as pickled dataframes are not stable across pandas versions
+        db_state = self.get_database_state()
+        cache_key = f"{db_state}|{self.query_user}|{self.period}|{self.carbon}|{pd.__version__}"
+        with self.open_query_cache() as query_cache:
+            try:
+                if cache_key in query_cache:
+                    return query_cache[cache_key]
+            except Exception:
+                # A damaged entry is treated as a cache miss and removed
+                with contextlib.suppress(Exception):
+                    del query_cache[cache_key]
+
+        # Open a read-only connection to the database. Reads go through mmap and
+        # a larger page cache, and temporary b-trees (for the GROUP BY) stay in memory
+        conn = sqlite3.connect(pathlib.Path(self.db_path).resolve().as_uri() + "?mode=ro", uri=True)
+        conn.executescript("""PRAGMA mmap_size=268435456;
+                              PRAGMA cache_size=-65536;
+                              PRAGMA temp_store=MEMORY;""")
+
+        # Aggregate the statistics per user inside SQLite, with the period (and user)
+        # passed as query parameters. The logdate and user columns are indexed
+        # by scrapeTorque.py, so only one row per user is shipped to pandas.
+        query = """SELECT user,
+                          SUM(mem_mb)               AS mem_mb,
+                          SUM(mem_req_mb)           AS mem_req_mb,
+                          SUM(cput_sec)             AS cput_sec,
+                          SUM(walltime_sec * nproc) AS req_cpu_sec,
+                          SUM((mem_req_mb - mem_mb) / 1000.0 / (walltime_sec / 3600.0)) AS waste_gb_hour"""
+
+        # The remaining figures are only used for the carbon load
+        if self.carbon:
+            query += """,
+                          SUM(nproc)                AS nproc,
+                          SUM(ngpus)                AS ngpus,
+                          AVG(cput_sec)             AS cput_mean_sec"""
+
+        query += """
+                   FROM torque_logs
+                   WHERE logdate >= date('now', ?)"""
+        params = [f"-{self.period} day"]
 
-        # Extract data
         # in case of a defined user
         if self.query_user is not None:
-            data = pd.read_sql_query(f"""SELECT * from torque_logs
-                                        WHERE logdate >= date('now', '-{self.period} day') 
-                                        AND user = '{self.query_user}'""",
-                                        conn)
-        else:
-            data = pd.read_sql_query(f"""SELECT * from torque_logs
-                                        WHERE logdate >= date('now', '-{self.period} day')""",
-                                        conn)
+            query += " AND user = ?"
+            params.append(self.query_user)
+
+        query += " GROUP BY user"
+        data = pd.read_sql_query(query, conn, params=params, index_col="user")
 
         # See if extracted dataframe is empty
         if data.empty:
@@ -143,16 +187,57 @@ class CRUCs(object):
                 print(f"-- No data for user {color_text(self.query_user,'purple')} in the past {self.period} days.")
                 print(f"   Check the user name or try a different period.")
             else:
-                print("-- No data for the last {self.period} days. Try again")
+                print(f"-- No data for the last {self.period} days. Try again")
             sys.exit(1)
 
         # Close database connection
         conn.close()
 
+        # Cache the result. Results for earlier states of this database are removed.
+        # The cache is only an optimization, so failing to update it is ignored
+        db_path = db_state.split("|")[0]
+        with self.open_query_cache() as query_cache:
+            try:
+                for key in [key for key in query_cache if key.startswith(db_path + "|") and not key.startswith(db_state + "|")]:
+                    del query_cache[key]
+                query_cache[cache_key] = data
+            except Exception:
+                pass
+
         return data
 
 
 
+    ## --- Describe the current state of the database --- ##
+    def get_database_state(self):
+        """
+        Return a string identifying the database file, its last modification
+        and the current (UTC) date used by the query.
+        """
+
+        db_path = os.path.abspath(self.db_path)
+        stat = os.stat(db_path)
+        today = datetime.datetime.now(datetime.timezone.utc).date().isoformat()
+
+        return f"{db_path}|{stat.st_mtime_ns}|{stat.st_size}|{today}"
+
+
+
+    ## --- Open the cache of earlier query results --- ##
+    def open_query_cache(self):
+        """
+        Open the query cache. If it can not be opened (e.g. it is damaged),
+        a dummy cache is used.
+        """
+
+        try:
+            os.makedirs(os.path.dirname(QUERY_CACHE), exist_ok=True)
+            return shelve.open(QUERY_CACHE)
+        except Exception:
+            return contextlib.nullcontext({})
+
+
+
     ## --- Compute statistics from log data --- ##
     def compute_stats(self):
         """
@@ -161,63 +246,36 @@ class CRUCs(object):
         """
 
         ## Compute statistics
-        mem_eff = self.calculate_mem_efficiency(self.query_data[["user", "mem_req_mb", "mem_mb"]])
-        cpu_eff = self.calculate_cpu_efficiency(self.query_data[["user", "walltime_sec", "cput_sec", "nproc"]])
-        mem_waste = self.calculate_mem_waste(self.query_data[["user", "mem_req_mb", "mem_mb", "walltime_sec"]])
+        efficiency = self.calculate_efficiency(self.query_data)
+        mem_waste = self.calculate_mem_waste(self.query_data)
         #pdb.set_trace()
 
         if self.carbon:
             # Compute carbon load
             #pdb.set_trace()
-            carbon_load = self.compute_carbon_load(self.query_data)
-            co2_eff = carbon_load.T
+            co2_eff = self.compute_carbon_load(self.query_data)
 
         ## Concat results to a single data frame
         if self.carbon:
-            data_stats = pd.concat([mem_eff, cpu_eff, mem_waste, co2_eff], axis = 1)
+            data_stats = pd.concat([efficiency, mem_waste, co2_eff], axis = 1)
         else:
-            data_stats = pd.concat([mem_eff, cpu_eff, mem_waste], axis = 1)
+            data_stats = pd.concat([efficiency, mem_waste], axis = 1)
 
-        # Rename index
+        # Rename index and order users once (the groupbys above keep their order of appearance)
         data_stats.index.names = ["User"]
+        data_stats = data_stats.sort_index()
 
         return data_stats
 
 
-    def calculate_mem_efficiency(self, data):
-        """
-        Calculate relative memory efficiency. Return results as a pandas dataframe.
-        """
-
-        # Calculate efficiency
-        data = data[["user", "mem_req_mb", "mem_mb"]].copy()
-        data.loc[:,"eff"] = data["mem_mb"] / data["mem_req_mb"]
-        data.loc[:,"frac"] = data["mem_req_mb"] / data.groupby("user")["mem_req_mb"].transform(sum)
-        data.loc[:,"mem_eff"] = data["eff"] * data["frac"]
-
-        # Sort and clip at 1
-        stats = data.loc[:, ["user", "mem_eff"]].groupby("user").sum(numeric_only=True)
-        stats.loc[:,"mem_eff"] = stats["mem_eff"].clip(upper=1)
-
-        return stats
-
-
-
-    def calculate_cpu_efficiency(self, data):
+    def calculate_efficiency(self, data):
         """
-        Calculate cpu efficiency. Return results as a pandas dataframe.
+        Calculate relative memory and cpu efficiency. Return results as a pandas dataframe.
         """
 
-        # Calculate efficiency
-        data = data[["user", "walltime_sec", "cput_sec", "nproc"]].copy()
-        data.loc[:,"requested"] = data["walltime_sec"] * data["nproc"]
-        data.loc[:,"eff"] = data["cput_sec"] / data["requested"]
-        data.loc[:,"frac"] = data["requested"] / data.groupby("user")["requested"].transform(sum)
-        data.loc[:,"cpu_eff"] = data["eff"] * data["frac"]
-
-        # Sort and clip at 1
-        stats = data.loc[:, ["user","cpu_eff"]].groupby("user").sum()
-        stats.loc[:,"cpu_eff"] = stats["cpu_eff"].clip(upper=1)
+        # The request-weighted mean efficiency is the ratio of the per-user sums. Clip at 1
+        stats = pd.DataFrame({"mem_eff": (data["mem_mb"] / data["mem_req_mb"]).clip(upper=1),
+                              "cpu_eff": (data["cput_sec"] / data["req_cpu_sec"]).clip(upper=1)})
 
         return stats
 
@@ -228,13 +286,8 @@ class CRUCs(object):
         Calculate absolute memory waste. Return results as a pandas dataframe.
         """
         
-        # Calculate efficiency
-        data = data[["user", "mem_req_mb", "mem_mb", "walltime_sec"]].copy()
-        data.loc[:,"waste_gb_hour"] = (data["mem_req_mb"] - data["mem_mb"]) / 1000 / (data["walltime_sec"] / 3600)
-
-        # Sort and clip at 1
-        stats = data.loc[:, ["user", "waste_gb_hour"]].groupby("user").sum(numeric_only=True)
-        stats = stats.rename(columns={"waste_gb_hour": "mem_waste_gb_hour"})
+        # The waste per job is summed per user in the database query
+        stats = data[["waste_gb_hour"]].rename(columns={"waste_gb_hour": "mem_waste_gb_hour"})
         # turn into integer and turn NAN to 0
         stats["mem_waste_gb_hour"] = stats["mem_waste_gb_hour"].fillna(0).apply(lambda x: int(x))
 
@@ -242,54 +295,39 @@ class CRUCs(object):
 
 
 
-    def convert_seconds_to_datetimeString(self, seconds):
-        """
-        Convert seconds integer to HH:MM:SS format
-        """
-
-        min, sec = divmod(seconds, 60)
-        hour, min = divmod(min, 60)
-
-        return '%d:%02d:%02d' % (hour, min, sec)
-
-
-
     def compute_carbon_load(self, data):
         """
         This function computes the carbon load for different users.
         It uses the amazing CarbonMeter module to do this. Wow!
+        All users are passed to CarbonMeter at once, as one forecast job per user.
         """
 
-        # First Caluclate the total resource use per user
-        record_sums = data.drop('cput_sec', axis=1).groupby('user').sum(numeric_only=True)
-        cput_mean = data.groupby('user')['cput_sec'].mean()
-
-        user_data = pd.concat([record_sums, cput_mean], axis=1)
-        user_data.loc[user_data['cput_sec'] == 0, 'cput_sec'] = 1
-
-        # Define variables
-        users    =  user_data.index.values
-        cpus     =  user_data["nproc"]
-        gpus     =  user_data["ngpus"]
-        mem_gb   = (user_data["mem_req_mb"] / 1000).astype(int)
-        walltime =  user_data["cput_sec"].apply(lambda row: self.convert_seconds_to_datetimeString(row))
-
-        # Compute carbon load
-        carbon_load = {}
-        # Loop over users and their metrics
-        for walltime, mem_gb, cpus, gpus, user in zip(walltime, mem_gb, cpus, gpus, users):
-
-            # Compute carbon load with CarbonMeter
-            carbon_obj = CarbonMeter.CarbonMeter([walltime, mem_gb, cpus, gpus], "forecast")
-            carbon_obj.run()
-            carbon_stats = carbon_obj.stats_out
-
-            # Format results and add to dictionary
-            carbon_kg = carbon_stats["total_emissions"] / 1000 # Change carbon unit from g to kg
-            car_km = carbon_stats["rel_car_1km"]
-            carbon_load[user] = {"carbon_load": int(carbon_kg)}# , "car_km": round(car_km, 0)}
-
-        carbon_load = pd.DataFrame.from_dict(carbon_load)
+        # The total resource use per user is summed in the database query.
+        # The mean cpu time is used as walltime (at least one second, as in CarbonMeter)
+        walltime_sec = data["cput_mean_sec"].to_numpy().astype(np.int64).clip(min=1)
+        walltime     = pd.to_timedelta(walltime_sec, unit="s")
+        mem_gb       = (data["mem_req_mb"] / 1000).astype(int).to_numpy()
+        start_time   = pd.Timestamp.now()
+
+        # Describe the users as forecast jobs, in the format of CarbonMeter's stats dataframe.
+        # CarbonMeter reads a memory figure without unit as MB
+        jobs = pd.DataFrame({"start_time": start_time,
+                             "end_time":   start_time + walltime,
+                             "cores":      data["nproc"].to_numpy(),
+                             "gpus":       data["ngpus"].to_numpy(),
+                             "memory_gb":  mem_gb / 1000,
+                             "cpu_time":   walltime_sec * data["nproc"].to_numpy(),
+                             "walltime":   walltime}, index = data.index)
+
+        # Compute carbon load of all users with CarbonMeter. The user input is only
+        # a placeholder, as the jobs are set directly
+        carbon_obj = CarbonMeter.CarbonMeter(["0:00:01", 1, 1, 0], "forecast")
+        carbon_obj.stats_df = jobs
+        carbon_obj.calculate_resource_use()
+
+        # Format results. Change carbon unit from g to kg
+        carbon_kg = carbon_obj.stats_df["emissions_g"].round(2) / 1000
+        carbon_load = pd.DataFrame({"carbon_load": carbon_kg.astype(int)})
 
         return carbon_load
 
@@ -323,8 +361,8 @@ def print_user_report(df, show_carbon = True):
 
     # Define data and reformat data
     user_data = df
-    user_data.loc[:,"mem_eff"] = round(user_data.loc[:,"mem_eff"] * 100, 2)
-    user_data.loc[:,"cpu_eff"] = round(user_data.loc[:,"cpu_eff"] * 100, 2)
+    user_data["mem_eff"] = (user_data["mem_eff"] * 100).round(2)
+    user_data["cpu_eff"] = (user_data["cpu_eff"] * 100).round(2)
     user_data = user_data.T
 
     # Add units
@@ -359,46 +397,48 @@ def print_results(df, query_user, top_n = 5):
         metric (string) the metric to plot (memory, CPU time, or carbon).
     """
 
+    # Get key values that are the same for all metrics
+    terminal_width = shutil.get_terminal_size().columns - 10    # Terminal width
+    current_user = getpass.getuser()                            # Current user
+
     # Loop over metrics
     for metric in df.columns:
 
-        # Set title and sort DataFrame
+        # Set title
         if metric == 'mem_eff':
             title  = "Memory efficiency \U0001F40F"
-            df_metric = df.copy().sort_values(metric, ascending=False)
         elif metric == 'cpu_eff':
             title  = "CPU efficiency \U0001F551"
-            df_metric = df.copy().sort_values(metric, ascending=False)
         elif metric == 'mem_waste_gb_hour':
             title  = "Memory waste \U0001F5D1"
-            df_metric = df.copy().sort_values(metric, ascending=False)
         elif metric == 'carbon_load':
             title  = "Carbon load \U0001F4A8"
-            df_metric = df.copy().sort_values(metric, ascending=False)
+
+        # Sort DataFrame (sort_values returns a new frame, so df is left untouched).
+        # The stable sort keeps tied users in alphabetical order
+        df_metric = df.sort_values(metric, ascending=False, kind="stable")
 
         # Move index to 'User' column and change index to rank
-        df_metric.reset_index(inplace=True)
+        df_metric = df_metric.reset_index()
 
         # Get key values
         max_result = df_metric[metric].max()                        # MAX value
-        terminal_width = shutil.get_terminal_size().columns - 10    # Terminal width
-        current_user = getpass.getuser()                            # Current user
+        is_current_user = df_metric['User'].to_numpy() == current_user   # Rows of the current user
 
         # If 'name' is provided, find the index of the entry matching 'name' in the DataFrame
         name_index = None
         if query_user is not None:
-            name_index = df_metric[df_metric['User'] == current_user].index
+            name_index = df_metric.index[is_current_user]
 
         # Calculate the maximum width for rank and username based on terminal width
         max_rank_width = len(str(df_metric.index.max() + 1)) + 4
         max_username_width = 14
-        #max_result_width = (df_metric[metric] * 100 if metric != 'carbon_load' else df_metric[metric]).apply(lambda x: f"{x:.2%}").str.len().max()
         max_bar_length = terminal_width - max_rank_width - max_username_width - 25
 
         # Limit df to top entries and the entry matching self.name
         df_top = df_metric.head(top_n)
-        if current_user not in df_top['User'].values:
-            df_top = pd.concat([df_top, df_metric[df_metric['User'] == current_user]])
+        if not is_current_user[:top_n].any():
+            df_top = pd.concat([df_top, df_metric[is_current_user]])
 
         # Print the header
         if metric == 'mem_waste_gb_hour':
@@ -408,20 +448,23 @@ def print_results(df, query_user, top_n = 5):
         else:
             scale = "Efficiency (used / requested resources)"
 
-        print("")
-        print(f"\033[94m----- {title} {'-' * (terminal_width - len(title))}\033[00m")
-        print( "")
-        print(f"  Rank  Username       | {scale}{' ' * (max_bar_length - len(scale) - 1)}")
+        # The output of each metric is collected and written to the terminal at once
+        lines = ["",
+                 f"\033[94m----- {title} {'-' * (terminal_width - len(title))}\033[00m",
+                 "",
+                 f"  Rank  Username       | {scale}{' ' * (max_bar_length - len(scale) - 1)}"]
+
+        # Formatting that is the same for every row of this metric
+        is_absolute   = metric in ['carbon_load', 'mem_waste_gb_hour']
+        top_color     = '\033[95m' if is_absolute else '\033[32m'  # Magenta for the most CO2 heavy entry, green for the most efficient
+        result_format = ',' if is_absolute else '.2%'
 
         # Loop through each row in the DataFrame and print the top entries or the entry matching 'name'
-        for index, row in df_top.iterrows():
+        for index, username, result in df_top[['User', metric]].itertuples(index=True, name=None):
             rank = index + 1  # Rank starts from 1
-            username = row['User']
-            result = row[metric]
 
             # Calculate the length of the bar based on the 'Result' value and maximum bar length
-            if metric in ['carbon_load', 'mem_waste_gb_hour']:
-                max_result = df_metric[metric].max()
+            if is_absolute:
                 bar_length = int(result * max_bar_length / max_result)
             else:
                 bar_length = int(result * max_bar_length)
@@ -432,10 +475,7 @@ def print_results(df, query_user, top_n = 5):
 
             # Determine the color for printing based on the rank, username, and 'name' parameter
             if rank == 1:
-                if metric in ['carbon_load', 'mem_waste_gb_hour']:
-                    rank_color = '\033[95m'  # Magenta color for the most CO2 heavy entry
-                else:
-                    rank_color = '\033[32m'  # Green color for the most efficient entry
+                rank_color = top_color
             elif username == current_user:
                 rank_color = '\033[94m'  # Purple color for the current user's entry
             elif name_index is not None and index in name_index:
@@ -445,13 +485,11 @@ def print_results(df, query_user, top_n = 5):
 
 
             # Print the rank, username, the horizontal bar with the 'Result' value ,
-            if metric in ['carbon_load', 'mem_waste_gb_hour']:
-                print(f"{rank_color}{padded_rank}. {padded_username} |{'■' * bar_length}{' ' * (max_bar_length - bar_length)}| {result:,}")
-            else:
-                print(f"{rank_color}{padded_rank}. {padded_username} |{'■' * bar_length}{' ' * (max_bar_length - bar_length)}| {result:.2%}")
+            lines.append(f"{rank_color}{padded_rank}. {padded_username} |{'■' * bar_length}{' ' * (max_bar_length - bar_length)}| {result:{result_format}}")
 
         # Reset color to default after printing
-        print('\033[0m')
+        lines.append(RESET_COLOR)
+        sys.stdout.write("\n".join(lines) + "\n")
 
 
 
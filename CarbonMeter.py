@@ -28,15 +28,34 @@
 """
 
 import argparse
+import concurrent.futures
+import contextlib
 import datetime
-import math
+import functools
+import mmap
 import os
 import re
+import shelve
 import sys
 import subprocess
+from typing import NamedTuple, Optional
 import yaml
+import numpy as np
 import pandas as pd
-import pdb
+
+## --- Regex patterns for parsing the tracejob and snakemake logs
+RE_DATETIME = re.compile(r"(\d{2}/\d{2}/\d{4} \d{2}:\d{2}:\d{2})")
+RE_CPUT     = re.compile(r"resources_used\.cput=(\d+)")
+RE_MEM      = re.compile(r"resources_used\.mem=(\d+\w+)")
+RE_WALLTIME = re.compile(r"resources_used\.walltime=(\d+:\d+:\d+)")
+RE_JOB_ID   = re.compile(rb"Submitted job \d+ with external jobid '(\d+)\.")
+DATETIME_FORMAT = "%m/%d/%Y %H:%M:%S"
+
+## --- Cache of jobs that have already been parsed from tracejob
+JOB_CACHE = os.path.join(os.path.expanduser("~"), ".cache", "CarbonMeter", "jobs")
+
+## --- Size of the memory units in kb
+MEM_UNITS_KB = {'kb': 1, 'mb': 1000, 'gb': 1000000, 'tb': 1000000000}
 
 ## --------------------------------------------------------- ##
 ##                       HELPER FUNCTIONS                    ##
@@ -49,21 +68,39 @@ def convert_memory_to_gb(memory):
     # Convert to GB
     # Asuume MB if no unit is given
     try:
-        memory = int(memory) / 1000
+        return int(memory) / 1000
     except ValueError:
-        if memory[-2:] == 'kb':
-            memory = int(memory[0:-2]) / 1000000
-        elif memory[-2:] == 'mb':
-            memory = int(memory[0:-2]) / 1000
-        elif memory[-2:] == 'gb':
-            memory = int(memory[0:-2])
-        elif memory[-2:] == 'tb':
-            memory = int(memory[0:-2]) * 1000
-        else:
+        unit_kb = MEM_UNITS_KB.get(memory[-2:].lower())
+        if unit_kb is None:
             print(f"Memory unit {str(memory[-2:])} not recognized. Please use kb, mb, gb or tb")
             sys.exit()
 
-    return memory
+    return int(memory[:-2]) * unit_kb / 1000000
+
+
+## --- Function for converting a column of memory strings to GB
+def convert_memory_series_to_gb(memory):
+
+    # Split into amount and unit
+    # Asuume MB if no unit is given
+    memory = memory.str.extract(r"^(\d+)([a-zA-Z]*)$")
+    unit_kb = memory[1].str.lower().map(MEM_UNITS_KB).where(memory[1] != "", 1000)
+
+    if unit_kb.isna().any():
+        unknown_unit = memory.loc[unit_kb.isna(), 1].iloc[0]
+        print(f"Memory unit {str(unknown_unit)} not recognized. Please use kb, mb, gb or tb")
+        sys.exit()
+
+    return memory[0].astype("int64") * unit_kb / 1000000
+
+
+## --- Function for loading a detailed (hour by month/weekday) reference table
+## The tables are cached, so they are only read once per path
+@functools.lru_cache(maxsize=8)
+def load_reference_table(path):
+
+    hours = [str(n) for n in range(0,24)]
+    return pd.read_csv(path, delimiter='\t', names = hours, dtype = {hour: 'float64' for hour in hours}, engine = 'c')
 
 
 ## --------------------------------------------------------- ##
@@ -71,6 +108,22 @@ def convert_memory_to_gb(memory):
 ## --------------------------------------------------------- ##
 
 
+class JobRecord(NamedTuple):
+
+    """
+    Figures of a single job as they are read from the tracejob log.
+    Times and memory are kept as strings and parsed for all jobs at once.
+    """
+
+    start_time: Optional[str]
+    end_time:   str
+    memory_gb:  str
+    cpu_time:   int
+    walltime:   str
+
+
+
+
 class ForecastStats():
 
     """
@@ -180,144 +233,188 @@ class JobStats():
         return stats_df
 
 
-    ## -- Function to parse walltime
-    def parse_walltime(self, walltime):
+    ## -- Function to extract jobids from a snakemake logfile
+    def get_ids_from_logfile(self):
 
-        # Get walltime components
-        walltime = walltime.split(':')
-        hours = int(walltime[0])
-        minutes = int(walltime[1])
-        seconds = int(walltime[2])
+        # An empty log file cannot be memory mapped (and holds no jobs)
+        if os.path.getsize(self.user_input) == 0:
+            return []
 
-        # Convert to seconds
-        walltime = datetime.timedelta(hours=hours, minutes=minutes, seconds=seconds)
+        ## Map the log file into memory and find all submitted jobs in one pass
+        with open(self.user_input, 'rb') as file, \
+             mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as log:
+            id_list = [job_id.decode() for job_id in RE_JOB_ID.findall(log)]
 
-        return walltime
+        return id_list
 
 
 
-    ## -- Function to extract jobids from a snakemake logfile
-    def get_ids_from_logfile(self):
+    ## --- Function for getting resources used by a single job from the torque/PBS log
+    def get_job_figures(self, job_id):
+
+        # Stream the log for that jobid
+        tracejob = subprocess.Popen(["tracejob", str(job_id), "-n", str(self.past_window), "-alm"],
+                                    stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                    bufsize=1, text=True)
 
-        ## Get times from log file
-        with open(self.user_input, 'r') as file:
+        # Create lists for storing log data
+        # Times are kept as strings and parsed for all jobs at once
+        start_times = []
+        walltimes   = []
+        cpu_times   = []
+        memories    = []
+        end_times   = []
+
+        # Iterate over log items
+        for line in tracejob.stdout:
+
+            # Skip lines without start time or resource information
+            line_start = "Job Run at request of" in line
+            line_resource = "resources_used" in line
+            if not (line_start or line_resource):
+                continue
 
-            id_list = []
-            id_pattern = "Submitted job \d+ with external jobid '(\d+)\."
+            # Get the timestamp of the line
+            line_time = RE_DATETIME.search(line)[1]
 
-            for line in file:
+            if line_start and not self.input_type == 'jobarray':
+                start_times.append(line_time)
 
-                log_id = re.search(id_pattern, line)
+            if line_resource:
 
-                if log_id:
-                    id_list.append(log_id[1].strip())
-        
-        return id_list
+                # Extract information
+                cpu_time = RE_CPUT.search(line)[1]
+                cpu_time = int(cpu_time)
+                cpu_times.append(cpu_time)
+
+                memory = RE_MEM.search(line)[1]
+                memories.append(memory)
+
+                end_times.append(line_time)
+
+                walltime = RE_WALLTIME.search(line)[1]
+                walltimes.append(walltime)
+
+                # If the input is a jobarray the start times are calculated from the walltime later on.
+                # There is only a single line in the job log for jobarrays.
+                if self.input_type == "jobarray":
+                    start_times.append(None)
+
+                # Skip remaining lines if input type is not jobarray
+                elif self.input_type != "jobarray":
+                    tracejob.terminate()
+                    break
+
+        # Close the log and check that tracejob did not fail
+        tracejob.stdout.close()
+        if tracejob.wait() > 0:
+            raise subprocess.CalledProcessError(tracejob.returncode, tracejob.args)
+
+        # Combine the figures to records
+        records = list(map(JobRecord._make, zip(start_times, end_times, memories, cpu_times, walltimes)))
+
+        # Return None when jobID has no record. This includes jobs without a
+        # resources line (still running or failed) and jobs that started before
+        # the search window. Jobs with a record have finished
+        if len(records) == 0:
+            return None, False
+
+        return records, True
+
+
+
+    ## --- Function for opening the cache of jobs that have already been parsed
+    def open_job_cache(self):
+
+        # Tasks in a jobarray may still be running, so only single jobs are cached
+        if self.input_type == "jobarray":
+            return contextlib.nullcontext({})
+
+        try:
+            os.makedirs(os.path.dirname(JOB_CACHE), exist_ok=True)
+            return shelve.open(JOB_CACHE)
+        except Exception:
+            return contextlib.nullcontext({})
+
+
+
+    ## --- Function for reading the figures of a job from the cache
+    ## Returns None if the job is not (or no longer) validly cached
+    def get_cached_figures(self, job_cache, job_id):
+
+        # A damaged entry (e.g. from concurrent runs) is removed and the job is fetched again
+        try:
+            figures = job_cache.get(job_id)
+        except Exception:
+            with contextlib.suppress(Exception):
+                del job_cache[job_id]
+            return None
+
+        if not figures:
+            return None
+
+        # Torque reuses job IDs once they wrap around. tracejob only searches the past
+        # window, so a cached job that ended before it is an older job with the same ID.
+        # A malformed entry is also treated as not cached
+        window_start = datetime.datetime.now() - datetime.timedelta(days=self.past_window)
+        try:
+            end_time = max(datetime.datetime.strptime(JobRecord._make(record).end_time, DATETIME_FORMAT) for record in figures)
+        except Exception:
+            return None
+        if end_time < window_start:
+            return None
+
+        return figures
 
 
 
     ## --- Function for getting resources used from torque/PBS log
     def get_tracejob_figures(self):
 
-        # Create lists for storing log data
-        start_time_list = []
-        end_time_list = []
-        cores_list = []
-        memory_list = []
-        cpu_time_list = []
-        walltime_list = []
-
-        for job_id in self.id_array:
-
-            # Extract log for that jobid
-            tracelog = subprocess.run(f"tracejob {job_id} -n {self.past_window} -alm",
-                                    shell = True, stdout=subprocess.PIPE,
-                                    check=True, stderr=subprocess.STDOUT)
-
-            # Reformat log
-            tracelog = tracelog.stdout.decode().split('\n')
-
-            # Create lists for storing log data
-            start_times = []
-            walltimes   = []
-            cpu_times   = []
-            memories    = []
-            end_times   = []
-
-            # Iterate over log items
-            for line in tracelog:
-
-                start_time = None
-                end_time = None
-
-                line_start = re.search("Job Run at request of", line)
-                line_resource = re.search("resources_used.", line)
-
-                if line_start and not self.input_type == 'jobarray':
-                    start_time = re.search("(\d{2}/\d{2}/\d{4} \d{2}:\d{2}:\d{2})",line)[1]
-                    start_time = datetime.datetime.strptime(start_time, "%m/%d/%Y %H:%M:%S")
-                    start_times.append(start_time)
-
-                if line_resource:
-
-                    # Extract information
-                    cpu_time = re.search("resources_used.cput=(\d+)",line)[1]
-                    cpu_time = int(cpu_time)
-                    cpu_times.append(cpu_time)
-
-                    memory = re.search("resources_used.mem=(\d+\w+)",line)[1]
-                    memory = convert_memory_to_gb(memory)
-                    #memory = int(memory[0:-2])
-                    memories.append(memory)
-
-                    end_time = re.search("(\d{2}/\d{2}/\d{4} \d{2}:\d{2}:\d{2})",line)[1]
-                    end_time = datetime.datetime.strptime(end_time, '%m/%d/%Y %H:%M:%S')
-                    end_times.append(end_time)
-
-                    walltime = re.search("resources_used.walltime=(\d+:\d+:\d+)",line)[1]
-                    walltime = self.parse_walltime(walltime)
-                    walltimes.append(walltime)
-
-                    # If the input is a jobarray then manually add times to start_times
-                    # There is only a single line in the job log for jobarrays.
-                    if self.input_type == "jobarray":
-                        start_time = end_time - walltime
-                        start_times.append(start_time)
-
-                    # Skip remaining lines if input type is not jobarray
-                    elif self.input_type != "jobarray":
-                        break
-
-            # If job has failed, no resources registered in the log file
-            # Add end time and assume 1 core and 100 MB memory
-            if start_time and not end_time:
-                end_time = datetime.datetime.now()
-                end_times.append(end_time)
-                cpu_times.append(end_time - start_time)
-                memories.append(100000)
-                walltimes.append(end_time - start_time)
-
-            # Estimate number of cores used and catch errors when jobID has no record
-            try:
-                cores = [ math.ceil(cpu_time / walltime.total_seconds()) for (cpu_time, walltime) in zip(cpu_times, walltimes) ]
-                if len(cores) == 0:
-                    raise UnboundLocalError
-            except UnboundLocalError:
-                print(f"Error: The jobID <{id}> does not appear in the logs of the past 90 days.", file = sys.stderr)
+        # Create list for storing the records of all jobs
+        records = []
+
+        with self.open_job_cache() as job_cache:
+
+            # Only query tracejob for jobs that are not in the cache
+            cached_figures = {}
+            for job_id in self.id_array:
+                figures = self.get_cached_figures(job_cache, str(job_id))
+                if figures is not None:
+                    cached_figures[job_id] = figures
+            new_ids = [job_id for job_id in self.id_array if job_id not in cached_figures]
+
+            # Query tracejob for several jobs at a time (the calls mostly wait on IO)
+            n_workers = max(1, min(32, len(new_ids)))
+            with concurrent.futures.ThreadPoolExecutor(max_workers=n_workers) as executor:
+                new_figures = dict(zip(new_ids, executor.map(self.get_job_figures, new_ids)))
+
+            # Collect figures in the order of the input and cache finished jobs
+            job_figures = []
+            for job_id in self.id_array:
+                if job_id in new_figures:
+                    figures, finished = new_figures[job_id]
+                    # The cache is only an optimization, so failing to update it is ignored
+                    if finished and figures:
+                        with contextlib.suppress(Exception):
+                            job_cache[str(job_id)] = [tuple(record) for record in figures]
+                else:
+                    figures = cached_figures[job_id]
+                job_figures.append(figures)
+
+        for job_id, figures in zip(self.id_array, job_figures):
+
+            # Skip jobs without a record
+            if figures is None:
+                print(f"Error: The jobID <{job_id}> does not appear in the logs of the past 90 days.", file = sys.stderr)
                 print( "       Please try a different jobID or change the search window to look further into past logs.", file = sys.stderr)
                 print(f"       If you are running CarbonMeter after a snakemake pipeline jobID {job_id} will not be included in the results.", file = sys.stderr)
                 continue
 
-            # Update lists
-            start_time_list.extend(start_times)
-            end_time_list.extend(end_times)
-            cores_list.extend(cores)
-            memory_list.extend(memories)
-            cpu_time_list.extend(cpu_times)
-            walltime_list.extend(walltimes)
+            records.extend(figures)
 
         # In case no jobs were found
-        if len(start_time_list) == 0:
+        if len(records) == 0:
             print("----------------------------------------------------------------------------------------", file = sys.stderr)
             print("NO JOBS FOUND. Please check your jobID and try again.", file = sys.stderr)
             print("Are you running CarbonMeter after a snakemake pipeline?", file = sys.stderr)
@@ -325,15 +422,24 @@ class JobStats():
             print("----------------------------------------------------------------------------------------", file = sys.stderr)
             sys.exit(0)
 
-        # combine lists to dataframe
-        stats_df = pd.DataFrame({'start_time': start_time_list,
-                                 'end_time':   end_time_list,
-                                 'cores':      cores_list,
-                                 'gpus' :      [0 for i in range(len(cores_list))],
-                                 'memory_gb':  memory_list,
-                                 'cpu_time':   cpu_time_list,
-                                 'walltime':   walltime_list})
+        # combine records to dataframe
+        stats_df = pd.DataFrame.from_records(records, columns=JobRecord._fields)
 
+        # Parse times and memory for all jobs at once
+        stats_df['end_time']  = pd.to_datetime(stats_df['end_time'], format=DATETIME_FORMAT, cache=True)
+        stats_df['walltime']  = pd.to_timedelta(stats_df['walltime'])
+        stats_df['memory_gb'] = convert_memory_series_to_gb(stats_df['memory_gb'])
+
+        # Jobarrays have no start time in the log, so it is calculated from the walltime
+        if self.input_type == "jobarray":
+            stats_df['start_time'] = stats_df['end_time'] - stats_df['walltime']
+        else:
+            stats_df['start_time'] = pd.to_datetime(stats_df['start_time'], format=DATETIME_FORMAT, cache=True)
+
+        # Estimate number of cores used (torque does not report GPUs used)
+        cores = np.ceil(stats_df['cpu_time'] / stats_df['walltime'].dt.total_seconds()).astype(int)
+        stats_df.insert(2, 'cores', cores)
+        stats_df.insert(3, 'gpus', 0)
 
         return stats_df
 
@@ -354,6 +460,7 @@ class CarbonMeter():
         self.config           = self.load_config(config_file)
         #self.location         = self.config['cluster']['location']
         self.emission_refs    = os.path.join(self.ref_dir, "emission_references.yaml")
+        self.reference_data   = self.load_emission_references(self.emission_refs)
         #self.carbon_intensity = self.set_reference_numbers(self.location, stat = "intensity")
         #self.energy_price, \
         #self.price_currency   = self.set_reference_numbers(self.location, stat = "price")
@@ -412,6 +519,15 @@ class CarbonMeter():
         return config_info
     
 
+    ## --- Load emission reference values (read once and reused for all jobs)
+    def load_emission_references(self, emission_refs):
+
+        with open(emission_refs, "r") as file:
+            reference_data = yaml.safe_load(file)
+
+        return reference_data
+
+
     ## --- Look up hardware specs
     def set_hardware_specs(self, config_info, hardware):
 
@@ -460,8 +576,7 @@ class CarbonMeter():
         if stat == "intensity":
 
             if reference_info['carbon']['custom_intensity_file']:
-                self.carbon_intensity = pd.read_csv(os.path.join(self.ref_dir, reference_info['carbon']['custom_intensity_file']),
-                                                    delimiter='\t', names = [str(n) for n in range(0,24)])
+                self.carbon_intensity = load_reference_table(os.path.abspath(os.path.join(self.ref_dir, reference_info['carbon']['custom_intensity_file'])))
             elif reference_info['carbon']['carbon_intensity']:
                 self.carbon_intensity = reference_info['carbon']['carbon_intensity']
             else:
@@ -473,6 +588,13 @@ class CarbonMeter():
                 print(f"Carbon intensity was not found. Please define it in the config file.")
                 sys.exit()
 
+            # Set up the lookup of carbon intensity by month and hour
+            if isinstance(self.carbon_intensity, pd.DataFrame):
+                intensity_table = self.carbon_intensity.to_numpy()
+                self.carbon_intensity_at = lambda times: intensity_table[times.month - 1, times.hour]
+            else:
+                self.carbon_intensity_at = None
+
         
         # Fetch energy price from config / reference file
         elif stat == "price":
@@ -481,8 +603,7 @@ class CarbonMeter():
                 self.energy_price = reference_info['price']['energy_price']
                 self.price_currency = reference_info['price']['price_currency']
             elif reference_info['price']['custom_price_table']:
-                self.energy_price = pd.read_csv(os.path.join(self.ref_dir, reference_info['price']['custom_price_table']),
-                                                    delimiter='\t', names = [str(n) for n in range(0,24)])
+                self.energy_price = load_reference_table(os.path.abspath(os.path.join(self.ref_dir, reference_info['price']['custom_price_table'])))
                 self.price_currency = reference_info['price']['price_currency']
             else:
                 energy_prices = pd.read_csv(os.path.join(self.ref_dir, reference_info['price']['price_ref']), delimiter=',')
@@ -494,6 +615,13 @@ class CarbonMeter():
                 print(f"Energy price/currency was not found. Please define it in the config file.")
                 sys.exit()
 
+            # Set up the lookup of energy price by weekday/weekend and hour
+            if isinstance(self.energy_price, pd.DataFrame):
+                price_table = self.energy_price.to_numpy()
+                self.energy_price_at = lambda times: price_table[(times.weekday > 5).astype(int), times.hour]  # 0 if weekday, 1 if weekend
+            else:
+                self.energy_price_at = None
+
 
 
     ## --- Format user input to avoid errors
@@ -514,28 +642,50 @@ class CarbonMeter():
     ## --- Calculate resource use
     def calculate_resource_use(self):
 
-        # Apply functions to dataframe to calculate different metrics
-        self.stats_df["ram_sticks"]     = self.stats_df.apply(lambda row: math.ceil(row["memory_gb"] / 16), axis = 1)
-        self.stats_df["cpu_efficiency"] = self.stats_df.apply(self.calculate_cpu_efficiency_row, axis = 1)
-        self.stats_df["energy_kwh"]     = self.stats_df.apply(self.calculate_energy_row, axis = 1)
-        self.stats_df["per_hour_kWh"]   = self.stats_df.apply(lambda row: row["energy_kwh"] / (row["walltime"].total_seconds() / 3600), axis = 1)
-        self.stats_df["energy_price"]   = self.stats_df.apply(self.calculate_energy_price_row, axis = 1)
-        self.stats_df["emissions_g"]    = self.stats_df.apply(self.calculate_emissions_row, axis = 1)
+        # Walltime in seconds is used by several of the metrics below
+        walltime_sec = self.stats_df["walltime"].dt.total_seconds()
+
+        # Calculate the simple metrics for all jobs at once
+        self.stats_df["ram_sticks"]     = np.ceil(self.stats_df["memory_gb"] / 16).astype(int)
+        self.stats_df["cpu_efficiency"] = self.stats_df["cpu_time"] / self.stats_df["cores"] / walltime_sec
+        self.stats_df["energy_kwh"]     = self.calculate_energy(walltime_sec)
+        self.stats_df["per_hour_kWh"]   = self.stats_df["energy_kwh"] / (walltime_sec / 3600)
+
+        # Energy used between start and end time
+        runtime_h   = (self.stats_df["end_time"] - self.stats_df["start_time"]).dt.total_seconds() / 3600
+        runtime_kWh = self.stats_df["per_hour_kWh"] * runtime_h.clip(lower=0)
+
+        # With detailed price/emission tables these depend on the hour the job ran,
+        # so they are summed over hourly steps
+        hourly_steps = None
+        if self.energy_price_at is not None or self.carbon_intensity_at is not None:
+            hourly_steps = self.get_hourly_steps()
+
+        self.stats_df["energy_price"]   = self.calculate_energy_price(runtime_kWh, hourly_steps)
+        self.stats_df["emissions_g"]    = self.calculate_emissions(runtime_kWh, hourly_steps)
 
 
 
     ## --- Calculate total resource use
     def calculate_total_resource_use(self):
 
-        # Calculate total CPU efficiency
-        total_cpu_time   = round(sum(self.stats_df["cpu_time"]) / 3600, 2)
-        job_rel_fraction = self.stats_df["cpu_time"] / total_cpu_time
-        total_efficiency = sum(job_rel_fraction * self.stats_df["cpu_efficiency"])
+        # Aggregate all columns in one go
+        totals = self.stats_df.agg({"cpu_time":     "sum",
+                                    "energy_kwh":   "sum",
+                                    "emissions_g":  "sum",
+                                    "energy_price": "sum",
+                                    "ram_sticks":   "sum",
+                                    "start_time":   "min",
+                                    "end_time":     "max"})
+
+        # Calculate total CPU efficiency (weighted by the CPU time of each job)
+        total_cpu_time   = round(totals["cpu_time"] / 3600, 2)
+        total_efficiency = np.average(self.stats_df["cpu_efficiency"], weights=self.stats_df["cpu_time"])
 
         # Calculate total resource use
-        total_energy_use = round(sum(self.stats_df["energy_kwh"]), 2)
-        total_emissions  = round(sum(self.stats_df["emissions_g"]), 2)
-        total_price      = round(sum(self.stats_df["energy_price"]), 2)
+        total_energy_use = round(totals["energy_kwh"], 2)
+        total_emissions  = round(totals["emissions_g"], 2)
+        total_price      = round(totals["energy_price"], 2)
 
 
         # Add total resource use to output dictionary
@@ -546,115 +696,85 @@ class CarbonMeter():
                           "total_efficiency": total_efficiency}
 
         # Add additional information to output dictionary
-        self.stats_out["global_time_start"] = min(self.stats_df["start_time"])
-        self.stats_out["global_time_end"]   = max(self.stats_df["end_time"])
+        self.stats_out["global_time_start"] = totals["start_time"]
+        self.stats_out["global_time_end"]   = totals["end_time"]
         self.stats_out["global_timespan"]   = round((self.stats_out["global_time_end"] - self.stats_out["global_time_start"]).total_seconds() / 3600, 2)
 
         # Calculate relative RAM use
-        self.stats_out["ram_sticks_used"] = sum(self.stats_df["ram_sticks"])
+        self.stats_out["ram_sticks_used"] = totals["ram_sticks"]
 
 
 
-    # --- Calculate CPU efficiency for a single row
-    def calculate_cpu_efficiency_row(self, row):
+    # --- Calculate energy use for all jobs
+    def calculate_energy(self, walltime_sec):
 
-        # Calculate CPU efficiency
-        cpu_efficiency = row["cpu_time"] / row["cores"] / row["walltime"].total_seconds()
-
-        return cpu_efficiency
-
-
-    # --- Calculate energy use for a single row
-    def calculate_energy_row(self, row):
-
-        # Read reference values from reference file
-        with open(self.emission_refs, "r") as file:
-            reference_data = yaml.safe_load(file)
+        hardware = self.config["cluster"]["hardware"]
 
         # Calculate energy use
-        energy_use_ram_W = row["cpu_time"] * row["ram_sticks"] * self.config["cluster"]["hardware"]["ram"]["watts_pr_GB"]
-        energy_use_cpu_W = row["cpu_time"] * self.config["cluster"]["hardware"]["cpu"]["watts"]
-        energy_use_gpu_W = row["gpus"] * row["walltime"].total_seconds() * self.config["cluster"]["hardware"]["gpu"]["watts"] 
+        energy_use_ram_W = self.stats_df["cpu_time"] * self.stats_df["ram_sticks"] * hardware["ram"]["watts_pr_GB"]
+        energy_use_cpu_W = self.stats_df["cpu_time"] * hardware["cpu"]["watts"]
+        energy_use_gpu_W = self.stats_df["gpus"] * walltime_sec * hardware["gpu"]["watts"]
 
         energy_use_kWh = (energy_use_cpu_W + energy_use_ram_W + energy_use_gpu_W) / 1000 / 3600
 
         return energy_use_kWh
 
 
-    # --- Calculate energy price for a single row
-    def calculate_energy_price_row(self, row):
+    # --- Split the runtime of every job into steps of one hour
+    def get_hourly_steps(self):
 
-        # Load reference data
-        if isinstance(self.energy_price, pd.DataFrame): 
-            price_ref_df = self.energy_price
-        else:
-            price_ref_df = None
-            price_ref = self.energy_price
+        start_time = self.stats_df["start_time"].to_numpy(dtype="datetime64[ns]")
+        end_time   = self.stats_df["end_time"].to_numpy(dtype="datetime64[ns]")
+        one_hour   = np.timedelta64(1, "h")
 
-        ## Calculate price
-        total_price = 0.0
-        current_time = row["start_time"]
+        # Number of steps per job and the position of each job's first step
+        n_steps = np.maximum((end_time - start_time) // one_hour + 1, 1)
+        offsets = np.concatenate(([0], np.cumsum(n_steps)[:-1]))
 
-        while current_time <= row["end_time"]:
-            # Get the weekday and hour values from the current time
-            weekday = (current_time.weekday() > 5)*1  # 0 if weekday, 1 if weekend
-            hour = current_time.hour
+        # Start time of every step of every job, laid out as one flat array
+        step_nr = np.arange(n_steps.sum()) - np.repeat(offsets, n_steps)
+        times   = np.repeat(start_time, n_steps) + step_nr * one_hour
 
-            # get time difference between current time and end of hour
-            time_diff = min(current_time + datetime.timedelta(hours=1), row["end_time"]) - current_time
-            time_diff = time_diff.total_seconds() / 3600
+        # Fraction of an hour spent in each step (the last step is usually shorter)
+        durations = np.minimum(times + one_hour, np.repeat(end_time, n_steps)) - times
+        durations = np.clip(durations / one_hour, 0, None)
 
-            # Get the price from the reference table
-            if price_ref_df is not None:
-                price = price_ref_df.iloc[weekday,hour]
-            else:
-                price = price_ref
+        # Energy used in each step
+        step_kWh = np.repeat(self.stats_df["per_hour_kWh"].to_numpy(), n_steps) * durations
 
-            # Add the price to the total
-            total_price += price * row["per_hour_kWh"] * time_diff
+        return pd.DatetimeIndex(times), step_kWh, offsets
 
-            # Increment the current time by 1 hour
-            current_time += datetime.timedelta(hours=1)
 
-        return total_price
+    # --- Calculate energy price for all jobs
+    def calculate_energy_price(self, runtime_kWh, hourly_steps):
 
+        # A single price for all hours is simply applied to the energy used
+        if self.energy_price_at is None:
+            return self.energy_price * runtime_kWh
 
-    # --- Calculate resource use for a single row
-    def calculate_emissions_row(self, row):
+        times, step_kWh, offsets = hourly_steps
 
-        # Load reference data
-        if isinstance(self.carbon_intensity, pd.DataFrame): 
-            emissions_ref_df = self.carbon_intensity
-        else:
-            emissions_ref_df = None
-            emissions_ref = self.carbon_intensity
+        # Get the price of each step from the reference table
+        price = self.energy_price_at(times)
 
-        # Calculate emissions
-        total_emissions = 0.0
-        current_time = row["start_time"]
+        # Sum the steps of each job
+        return np.add.reduceat(price * step_kWh, offsets)
 
-        while current_time <= row["end_time"]:
-            # Get the month and hour values from the current time
-            month = current_time.month - 1
-            hour = current_time.hour
 
-            # get time difference between current time and end of hour
-            time_diff = min(current_time + datetime.timedelta(hours=1), row["end_time"]) - current_time
-            time_diff = time_diff.total_seconds() / 3600
+    # --- Calculate emissions for all jobs
+    def calculate_emissions(self, runtime_kWh, hourly_steps):
 
-            # Get the emissions from the reference table
-            if emissions_ref_df is not None:
-                emissions = emissions_ref_df.iloc[month,hour]
-            else:
-                emissions = emissions_ref
+        # A single carbon intensity for all hours is simply applied to the energy used
+        if self.carbon_intensity_at is None:
+            return self.carbon_intensity * runtime_kWh
 
-            # Add the emissions to the total
-            total_emissions += emissions * row["per_hour_kWh"] * time_diff
+        times, step_kWh, offsets = hourly_steps
 
-            # Increment the current time by 1 hour
-            current_time += datetime.timedelta(hours=1)
+        # Get the emissions of each step from the reference table
+        emissions = self.carbon_intensity_at(times)
 
-        return total_emissions
+        # Sum the steps of each job
+        return np.add.reduceat(emissions * step_kWh, offsets)
 
 
 
@@ -662,10 +782,7 @@ class CarbonMeter():
     def calculate_emission_comparisons(self):
 
         emissions = self.stats_out["total_emissions"]
-
-        # Read reference values from reference file
-        with open(self.emission_refs, "r") as file:
-            reference_data = yaml.safe_load(file)
+        reference_data = self.reference_data
 
         ## Calculate relative emissions
         self.stats_out["rel_washing"]    = round(emissions / reference_data["emissions"]["washing_machine_cycle"]["CO2"], 2)
@@ -19,18 +19,103 @@
         python scrapeTorque.py <torque_logfile> 
 """
 
-import pandas as pd
 import datetime
+import concurrent.futures
+import functools
 import argparse
 import sqlite3
-import math
+import mmap
 import sys 
 import os
 import re
-import pdb
 
 ## ------------------- Definitions ------------------- ##
 
+# Lines with information on ended jobs
+EXIT_TOKEN = b"Exit_status="
+RE_EXIT_STATUS = re.compile(rb"Exit_status=-*\d+")
+
+# Patterns to extract information from server logs
+FIELDS_SERVER = {"user":          rb"user=(?P<user>\w+)",
+                 "exit_status":   rb"Exit_status=(?P<exit_status>\d+)",
+                 "used_walltime": rb"resources_used\.walltime=(?P<used_walltime>[0-9:]+)",
+                 "used_mem":      rb"resources_used\.mem=(?P<used_mem>\d+\w+)",
+                 "used_cput":     rb"resources_used\.cput=(?P<used_cput>\d+)"}
+
+# Patterns to extract information from accounting logs
+FIELDS_ACCOUNTING = {"user":          rb"user=(?P<user>\w+)",
+                     "exit_status":   rb"Exit_status=(?P<exit_status>\d+)",
+                     "req_walltime":  rb"Resource_List\.walltime=(?P<req_walltime>[0-9:]+)",
+                     "req_mem":       rb"Resource_List\.mem=(?P<req_mem>\d+\w+)",
+                     "req_nodes":     rb"Resource_List\.nodes=(?P<req_nodes>\d+)",
+                     "used_walltime": rb"resources_used\.walltime=(?P<used_walltime>[0-9:]+)",
+                     "used_mem":      rb"resources_used\.mem=(?P<used_mem>\d+\w+)",
+                     "used_cput":     rb"resources_used\.cput=(?P<used_cput>\d+)"}
+
+# A single pattern per log type, so each line is only scanned once
+RE_FIELDS_SERVER     = re.compile(b"|".join(FIELDS_SERVER.values()))
+RE_FIELDS_ACCOUNTING = re.compile(b"|".join(FIELDS_ACCOUNTING.values()))
+
+# The requested cpus and gpus are part of the Resource_List fields (e.g. nodes=1:ppn=4),
+# so they are searched for separately. As with the pattern Resource_List.+ppn=, the
+# last value after the first Resource_List key is used
+RESOURCE_LIST_TOKEN = b"Resource_List"
+RE_NUMBER = re.compile(rb"\d+")
+
+# Statement to add a job to the database (positional, in the order of the torque_logs columns)
+INSERT_SQL = "INSERT INTO torque_logs VALUES (?,?,?,?,?,?,?,?,?,?,?)"
+
+# Walltime in the format of the torque accounting file ([DD:]HH:MM:SS)
+RE_WALLTIME = re.compile(r"(?:(\d+):)?(\d+):(\d+):(\d+)")
+
+# Slots of the fields extracted from a line (shared by both log types)
+FIELD_SLOTS = ("date", "user", "exit_status", "req_walltime", "req_mem", "req_nodes",
+               "req_cpus", "req_gpus", "used_walltime", "used_mem", "used_cput")
+
+# Fields that are stored as integers (all others are kept as text)
+NUMERIC_FIELDS = {"exit_status", "req_nodes", "req_cpus", "req_gpus", "used_cput"}
+
+# Size of memory units in MB
+MEM_UNITS_MB = {"tb": 1024 * 1024, "gb": 1024, "mb": 1, "kb": 1 / 1024, "b": 1 / (1024 * 1024)}
+
+# Values of fields that are missing from a line (all others default to 1)
+FIELD_DEFAULTS = {"user": "server", "req_gpus": 0}
+
+# Requested walltimes and memory repeat a lot in the torque logs, so the
+# conversions are cached
+@functools.lru_cache(maxsize=8192)
+def walltime_to_seconds(walltime):
+    """
+    This function takes a walltime in the format of the torque accounting file
+    (DD:HH:MM:SS) and converts it to seconds.
+    """
+
+    # Split the walltime into days, hours, minutes and seconds
+    days, hours, minutes, seconds = RE_WALLTIME.fullmatch(walltime).groups(default="0")
+
+    # Convert to seconds
+    return int(days) * 86400 + int(hours) * 3600 + int(minutes) * 60 + int(seconds)
+
+
+@functools.lru_cache(maxsize=8192)
+def memory_to_mb(memory):
+    """
+    This function takes a memory request in the format of the torque accounting file
+    (e.g. 10gb) and converts it to MB.
+    """
+
+    # In case no memory was requested, assume a full node (180gb)
+    if memory == "1":
+        return 180 * 1024
+
+    # Split the memory into amount and unit (one or two letters)
+    memory_unit = memory[-2:] if memory[-2:] in MEM_UNITS_MB else memory[-1:]
+    memory_amount = int(memory[:-len(memory_unit)])
+
+    # Convert to MB
+    return round(memory_amount * MEM_UNITS_MB[memory_unit])
+
+
 class ScrapeTorque(object):
 
     def __init__(self, torque_path, log_path, past_window, server_logs):
@@ -39,6 +124,21 @@ class ScrapeTorque(object):
         self.past_window = past_window
         self.server_logs = server_logs
 
+        # Pattern and default values used to extract information. Each group of
+        # the pattern maps to a slot and a converter, indexed by group number.
+        self.re_fields = RE_FIELDS_SERVER if server_logs else RE_FIELDS_ACCOUNTING
+        self.group_slots = [None] * (self.re_fields.groups + 1)
+        self.group_converters = [None] * (self.re_fields.groups + 1)
+        for name, group in self.re_fields.groupindex.items():
+            self.group_slots[group] = FIELD_SLOTS.index(name)
+            self.group_converters[group] = int if name in NUMERIC_FIELDS else bytes.decode
+        self.slot_defaults = [FIELD_DEFAULTS.get(name, 1 if name in NUMERIC_FIELDS else "1") for name in FIELD_SLOTS]
+        self.resource_keys = ((FIELD_SLOTS.index("req_cpus"), b"ppn="),
+                              (FIELD_SLOTS.index("req_gpus"), b"gpu=" if server_logs else b"gpus="))
+
+        # Requested resources are computed differently for server logs
+        self.get_requests = self.get_server_requests if server_logs else self.get_accounting_requests
+
     ## ---------------------- Run --------------------- ##
 
     def run(self):
@@ -57,13 +157,27 @@ class ScrapeTorque(object):
 
         # Go through the list of dates and extract the information
         print(f"-- Updating database with logs since {last_date} --")
-        for torque_file in torque_file_list:
+        torque_files = self.get_torque_files(torque_file_list)
+
+        # Files are parsed in parallel, while rows are added to the database
+        # by this process in the order of the dates
+        cursor.execute("BEGIN")
+        with concurrent.futures.ProcessPoolExecutor() as executor:
+            for date, rows in zip(torque_files, executor.map(self.extract_torque_data, torque_files.values())):
 
-            # Extract information and add to database
-            self.extract_torque_data(torque_file, conn, cursor)
+                # Add info to database
+                cursor.executemany(INSERT_SQL, rows)
+                print(f" > Updated database with info from {date}")
 
 
-        # Commit and close connection
+        # Update the statistics of the query planner, then commit and close connection.
+        # A full ANALYZE is only run while there are no statistics yet. After that,
+        # PRAGMA optimize only re-analyzes the table once it has changed a lot
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'sqlite_stat1'")
+        if cursor.fetchone() is None:
+            cursor.execute("ANALYZE")
+        else:
+            cursor.execute("PRAGMA optimize")
         conn.commit()
         conn.close()
 
@@ -85,11 +199,21 @@ class ScrapeTorque(object):
         #    exit(1)
 
         # Connect to the database
-        conn = sqlite3.connect(database,
-                               detect_types=sqlite3.PARSE_DECLTYPES |
-                               sqlite3.PARSE_COLNAMES)
+        conn = sqlite3.connect(database)
         cursor = conn.cursor()
 
+        # Tune the connection for bulk inserts. The database can always be rebuilt
+        # from the torque logs, so it is safe to skip syncing to disk. The page
+        # size only takes effect when the database is created (or VACUUMed). The journal mode is
+        # stored in the database file, so it is kept at (or set back to) DELETE:
+        # in WAL mode, users without write access to the folder cannot read it.
+        cursor.executescript("""PRAGMA page_size=8192;
+                                PRAGMA mmap_size=268435456;
+                                PRAGMA journal_mode=DELETE;
+                                PRAGMA synchronous=OFF;
+                                PRAGMA temp_store=MEMORY;
+                                PRAGMA cache_size=-65536;""")
+
         # Check for the existence of a table and create the raw table if it doesn't exist
         cursor.execute("""CREATE TABLE IF NOT EXISTS torque_logs (
                             logdate date,
@@ -105,6 +229,10 @@ class ScrapeTorque(object):
                             cput_sec integer
                             )""")
 
+        # Index the columns used to look up dates and users
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_torque_logdate ON torque_logs(logdate)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_torque_user_date ON torque_logs(user, logdate)")
+
         # Get latest date from database
         last_date = self.get_last_database_date(conn, cursor)
 
@@ -117,208 +245,178 @@ class ScrapeTorque(object):
         Fetch the date of the last data entry in the database
         """
 
-        # Fetch the date of the latest data entry
-        cursor.execute("SELECT logdate FROM torque_logs")
-        dates = [datelist[0] for datelist in cursor.fetchall()]
+        # Fetch the date of the latest data entry (stored as YYYY-MM-DD text)
+        cursor.execute("SELECT MAX(logdate) FROM torque_logs")
+        last_date = cursor.fetchone()[0]
 
-        # In case of no info in database, start at 01.01.2023
-        if len(dates) == 0:
-            last_date = datetime.datetime.strptime("20200101", "%Y%m%d")
+        # In case of no info in database, start at 01.01.2020
+        if last_date is None:
+            last_date = datetime.date(2020, 1, 1)
         else:
-            last_date = sorted(dates, 
-                                #key = lambda d: datetime.datetime.strftime(d, "%Y%m%d"),
-                                reverse=True)[0]
+            last_date = datetime.date.fromisoformat(last_date)
         
         print(f"-- Latest date in the database is {last_date} --")
 
         return last_date
 
 
-    def walltime_to_seconds(self, walltime):
+    def get_line_fields(self, line):
         """
-        This function takes a walltime in the format of the torque accounting file
-        (DD:HH:MM:SS) and converts it to seconds.
+        This function scans a line once with the combined field pattern and
+        returns a list of the fields in the order of FIELD_SLOTS, with numeric
+        fields as ints. Fields that are not found get their default value, and
+        fields that appear more than once keep their first value (except the
+        requested cpus and gpus, see RESOURCE_LIST_TOKEN).
         """
 
-        # Split the walltime into days, hours, minutes and seconds
-        walltime = walltime.split(":")
-        if len(walltime) == 3:
-            days = 0
-            hours = int(walltime[0])
-            minutes = int(walltime[1])
-            seconds = int(walltime[2])
-        elif len(walltime) == 4:
-            days = int(walltime[0])
-            hours = int(walltime[1])
-            minutes = int(walltime[2])
-            seconds = int(walltime[3])
+        fields = self.slot_defaults.copy()
+
+        # The date is always the first 10 characters of the line (MM/DD/YYYY)
+        fields[0] = line[:10].decode()
+
+        # A key may appear twice on a line (e.g. user= inside a jobname), so only
+        # the first match of each field is kept
+        filled = set()
+        for match in self.re_fields.finditer(line):
+            group = match.lastindex
+            slot = self.group_slots[group]
+            if slot not in filled:
+                filled.add(slot)
+                fields[slot] = self.group_converters[group](match.group(group))
+
+        # The requested cpus and gpus are only looked for after the first Resource_List key.
+        # The last occurrence of the key that is followed by a number is used
+        start = line.find(RESOURCE_LIST_TOKEN)
+        if start >= 0:
+            start += len(RESOURCE_LIST_TOKEN) + 1
+            for slot, key in self.resource_keys:
+                end = len(line)
+                while (pos := line.rfind(key, start, end)) >= 0:
+                    number = RE_NUMBER.match(line, pos + len(key))
+                    if number:
+                        fields[slot] = int(number.group())
+                        break
+                    end = pos
+
+        return fields
+
+
+    def get_accounting_requests(self, req_walltime, req_mem, req_nodes, req_cpus,
+                                used_walltime, used_mem, used_cput):
+        """
+        This function returns the requested cpus, walltime, memory and
+        cputime of a job in the torque accounting logs.
+        """
 
-        # Convert to seconds
-        seconds = days * 86400 + hours * 3600 + minutes * 60 + seconds
+        req_walltime = walltime_to_seconds(req_walltime)
+        req_cputime = req_walltime * req_cpus * req_nodes
 
-        return str(seconds)
+        return req_cpus, req_walltime, memory_to_mb(req_mem), req_cputime
 
 
-    def memory_to_mb(self, memory):
+    def get_server_requests(self, req_walltime, req_mem, req_nodes, req_cpus,
+                            used_walltime, used_mem, used_cput):
         """
-        This function takes a memory request in the format of the torque accounting file
-        (e.g. 10gb) and converts it to MB.
+        This function returns the requested cpus, walltime, memory and
+        cputime of a job in the torque server logs. These are not present
+        in the log files, so they are estimated from the used resources.
         """
 
-        # In case no memory was requested, assume a full node (180gb)
-        if memory == "1":
-            return str(180 * 1024)
+        req_cpus = round(used_cput / used_walltime + 1)
 
-        # Extract the memory amount and the unit
-        mem_match = re.match(r"([0-9]+)([a-z]+)", memory)
-        memory_amount = int(mem_match.group(1))
-        memory_unit   =     mem_match.group(2)
-        
-        # Convert to MB
-        if memory_unit == "gb":
-            memory = memory_amount * 1024
-        elif memory_unit == "mb":
-            memory = memory_amount
-        elif memory_unit == "kb":
-            memory = memory_amount / 1024
-        elif memory_unit == "b":
-            memory = memory_amount / 1024 / 1024
-            memory = math.ceil(round(memory))
-
-        return str(round(memory))
-
-    def get_line_match(self, name, pattern, string):
-        """
-        This function takes a string and a pattern and returns
-        a regex match. If no match is found, it returns 0.
-        """
-
-        match = re.search(pattern, string)
-        if match:
-            return match.group(1)
-        elif not match and name == "user":
-            return "server"
-        elif not match and name == "req_gpus":
-            return "0"
-        else:
-            return "1"
+        return req_cpus, used_walltime, used_mem, used_walltime * req_cpus
 
 
     def build_date_list(self, start_date, end_date):
         """
-        This function takes two dates in the format of the torque accounting file
-        and returns a list of dates in the same format.
+        This function takes two dates and returns a list of the days after
+        start_date up to and including end_date, in the format of the torque
+        accounting file names.
         """
-        # Convert the dates to datetime objects
-        start_date = datetime.datetime.strftime(start_date, "%Y%m%d")
-        end_date = datetime.datetime.strftime(end_date, "%Y%m%d")
 
         # Create a list of dates between the two dates
-        date_list = []
-        for date in pd.date_range(start_date, end_date, inclusive="right"):
-            date_list.append(date.strftime("%Y%m%d"))
+        n_days = (end_date - start_date).days
+        date_list = [(start_date + datetime.timedelta(days=day)).strftime("%Y%m%d")
+                     for day in range(1, n_days + 1)]
 
         return date_list
 
 
-    def extract_torque_data(self, date, conn, cursor):
+    def get_torque_files(self, date_list):
         """
-        This function goes through a torque accounting file and extracts
-        relevant information on resource use.
+        This function takes a list of dates and returns a dictionary of the
+        torque accounting files that exist for those dates.
         """
 
-        torque_file = os.path.join(self.torque_path, date)
+        # List the torque directory once instead of checking every date.
+        # If the directory is missing, every file is reported as missing below
+        try:
+            existing = {entry.name: entry for entry in os.scandir(self.torque_path) if entry.is_file()}
+        except FileNotFoundError:
+            existing = {}
+
+        torque_files = {}
+        for date in date_list:
+            torque_file = os.path.join(self.torque_path, date)
+
+            # Check if the file exists
+            if date not in existing:
+                print("File {} does not exist.".format(torque_file))
+
+            # An empty file cannot be memory mapped (and holds no jobs)
+            elif existing[date].stat().st_size == 0:
+                print("File {} is empty.".format(torque_file))
+
+            else:
+                torque_files[date] = torque_file
 
-        # Check if the file exists
-        if not os.path.isfile(torque_file):
-            print("File {} does not exist.".format(torque_file))
-            return
+        return torque_files
 
-        # Open the torque accounting file
-        with open(torque_file, "r") as infile:
-        #open(output_file, "a") as outfile:
+
+    def extract_torque_data(self, torque_file):
+        """
+        This function goes through a torque accounting file and extracts
+        relevant information on resource use. It returns a list of rows
+        for the database.
+        """
+
+        # Rows to add to the database
+        rows = []
+
+        # Open the torque accounting file and map it into memory
+        with open(torque_file, "rb") as infile, \
+             mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ) as torque_log:
 
             # Go through the file line by line
-            for line in infile:
+            for line in iter(torque_log.readline, b""):
 
-                # Find lines with information on ended jobs
-                if re.search("Exit_status=-*\d+", line):
+                # Find lines with information on ended jobs (the substring test
+                # skips most lines before any regex work)
+                if EXIT_TOKEN in line and RE_EXIT_STATUS.search(line):
 
                     # extract line
                     #line = line.strip("\n").split(" ")
 
-                    # Initialize dictionary
-                    data = {}
-
-                    # Define patterns to extract information
-                    if self.server_logs:
-                        patterns = {"date":          "(^[0-9/]{10})",
-                                    "user":          "user=(\w+)",
-                                    "exit_status":   "Exit_status=(\d+)",
-                                    "req_cpus":      "Resource_List.+ppn=(\d+)",
-                                    "req_gpus":      "Resource_List.+gpu=(\d+)",
-                                    "used_walltime": "resources_used\.walltime=([0-9:]+)",
-                                    "used_mem":      "resources_used\.mem=(\d+\w+)",
-                                    "used_cput":     "resources_used\.cput=(\d+)"}
-
-                    else:
-                        patterns = {"date":          "(^[0-9/]{10})",
-                                    "user":          "user=(\w+)",
-                                    "exit_status":   "Exit_status=(\d+)",
-                                    "req_walltime":  "Resource_List\.walltime=([0-9:]+)",
-                                    "req_mem":       "Resource_List\.mem=(\d+\w+)",
-                                    "req_nodes":     "Resource_List\.nodes=(\d+)",
-                                    "req_cpus":      "Resource_List.+ppn=(\d+)",
-                                    "req_gpus":      "Resource_List.+gpus=(\d+)",
-                                    "used_walltime": "resources_used\.walltime=([0-9:]+)",
-                                    "used_mem":      "resources_used\.mem=(\d+\w+)",
-                                    "used_cput":     "resources_used\.cput=(\d+)"}
-
                     # Extract information
-                    for name in patterns.keys():
-                        data[name] = self.get_line_match(name, patterns[name], line)
+                    (date, user, exit_status, req_walltime, req_mem, req_nodes,
+                     req_cpus, req_gpus, used_walltime, used_mem, used_cput) = self.get_line_fields(line)
 
                     # Skip if walltime is 0
-                    if data["used_walltime"] in ["0:00:00", "00:00:00"]:
+                    if used_walltime in ["0:00:00", "00:00:00"]:
                         continue
-                    
-                    # In case of server logs as input some values will need to be changed
-                    # as these are not present in the log files.
-                    if self.server_logs:
-                        data["req_walltime"] = data["used_walltime"]
-                        data["req_mem"] = data["used_mem"]
 
                     # Format extracted data for output
-                    logdate = datetime.datetime.strptime(data["date"], "%m/%d/%Y").date()
-                    req_walltime = self.walltime_to_seconds(data["req_walltime"])
-                    used_walltime = self.walltime_to_seconds(data["used_walltime"])
-                    req_mem = self.memory_to_mb(data["req_mem"])
-                    used_mem = self.memory_to_mb(data["used_mem"])
-
-                    if self.server_logs:
-                        data["req_cpus"] = str(round(int(data["used_cput"]) / int(used_walltime)+1))
-
-                    # Calculate required cputime
-                    if self.server_logs:
-                        req_cputime = str(int(req_walltime) * int(data["req_cpus"]))
-                    else:
-                        req_cputime = str(int(req_walltime) * int(data["req_cpus"]) * int(data["req_nodes"]))
-
-                    # Add info to database
-                    cursor.execute("""INSERT INTO torque_logs 
-                                      VALUES 
-                                       (:logdate, :user, :exit_status, :ngpus, :nproc,
-                                       :walltime_req_sec, :walltime_sec, :mem_req_mb,
-                                       :mem_mb, :cputime_req_sec, :cputime_sec)""", 
-                                       {"logdate": logdate, "user": data["user"],
-                                        "exit_status": data["exit_status"], "ngpus": data["req_gpus"],
-                                        "nproc":data["req_cpus"], "walltime_req_sec": req_walltime,
-                                        "walltime_sec": used_walltime, "mem_req_mb": req_mem,
-                                        "mem_mb": used_mem, "cputime_req_sec":  req_cputime,
-                                        "cputime_sec":data["used_cput"]})
-
-        # Print message after data extract            
-        print(f" > Updated database with info from {date}")
+                    logdate = datetime.date(int(date[6:10]), int(date[0:2]), int(date[3:5])).isoformat()
+                    used_walltime = walltime_to_seconds(used_walltime)
+                    used_mem = memory_to_mb(used_mem)
+                    req_cpus, req_walltime, req_mem, req_cputime = self.get_requests(
+                        req_walltime, req_mem, req_nodes, req_cpus, used_walltime, used_mem, used_cput)
+
+                    # Add info to the rows of this file
+                    rows.append((logdate, user, exit_status, req_gpus, req_cpus, req_walltime,
+                                 used_walltime, req_mem, used_mem, req_cputime, used_cput))
+
+        return rows
 
 
 